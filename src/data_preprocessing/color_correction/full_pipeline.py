@@ -1,14 +1,15 @@
 import os
-import sys
 import pandas as pd
 import numpy as np
 
 from data_preprocessing.color_correction.model_utils import load_model, image_preprocess
 from data_preprocessing.color_correction.transformation import calculate_matrix_transform, apply_color_correction
 from data_preprocessing.color_correction.visualization import plot_original_vs_corrected
+from data_preprocessing.sharding import CORRECTION_PREFIX, validate_shard_args, select_shard_positions, input_fingerprint, shard_file_name, write_shard_manifest
 from PIL import Image
 
-def run_color_correction_pipeline(folder_path, image_list=None, output_folder = 'colorcorrected_images/',  first_image_path=None, printing=True):
+def run_color_correction_pipeline(folder_path, image_list=None, output_folder = 'colorcorrected_images/',  first_image_path=None, printing=True,
+                                  shard_index=None, num_shards=None):
     """
     Runs the full color correction pipeline for a list of image paths provided via a CSV, Excel, list, or DataFrame.
 
@@ -16,17 +17,27 @@ def run_color_correction_pipeline(folder_path, image_list=None, output_folder =
     - folder_path: Path to the folder containing the images.
     - image_list: Can be empty, a single image path, a list of image paths, a CSV/Excel file, or a Pandas/Numpy DataFrame containing image paths. If empty, color correction is performed on all the images in the folder.
     - first_image_path: Optional reference image for minimal correction mode.
+    - shard_index, num_shards: Optional. Process only the images of this shard (split by stable hash of the image name),
+      so that a run can be spread over several nodes. The correction manifest is then written per shard.
+
+    Writes correction_manifest.csv (or correction_manifest.<shard>.csv) with the status of every image to the output folder.
     """
+    sharded = validate_shard_args(shard_index, num_shards)
     print(output_folder)
     load_model()
 
     # If image_list is empty, use all images in the folder
     if not image_list:
-        image_list = [
+        image_list = sorted(
             f for f in os.listdir(folder_path)
             if f.lower().endswith(('.jpg', '.jpeg', '.png'))
-        ]
+        )
 
+    if sharded:
+        input_id = input_fingerprint(image_list)
+        shard_rows = select_shard_positions(image_list, shard_index, num_shards)
+        image_list = [image_list[i] for i in shard_rows]
+        print(f"Shard {shard_index}/{num_shards}: {len(image_list)} images")
 
     first_image_colors = None
     if first_image_path:
@@ -34,15 +45,18 @@ def run_color_correction_pipeline(folder_path, image_list=None, output_folder =
 
     print(folder_path)
     print(output_folder)
-    os.makedirs(os.path.join(folder_path, output_folder), exist_ok=True)
+    output_path = os.path.join(folder_path, output_folder)
+    os.makedirs(output_path, exist_ok=True)
     
     # Process each image
+    manifest_rows = []
     for image_name in image_list:
+        image_path = os.path.join(folder_path, image_name)
         try:
-            image_path = os.path.join(folder_path, image_name)
             # Skip invalid paths
             if not os.path.exists(image_path):
                 print(f"Image not found: {image_path}")
+                manifest_rows.append([image_name, 'not_found', None])
                 continue
 
             print(f"\nProcessing: {image_path}")
@@ -56,14 +70,25 @@ def run_color_correction_pipeline(folder_path, image_list=None, output_folder =
             # Save the corrected image in the output folder
             corrected_image_path = os.path.join(folder_path, output_folder, image_name)
             corrected_img.save(corrected_image_path)
+            manifest_rows.append([image_name, 'corrected', corrected_image_path])
 
             if printing:
                 plot_original_vs_corrected(img, corrected_img, close=True)
 
         except np.linalg.LinAlgError as e:
             print(f"Skipping {image_path} due to singular matrix error: {e}")
+            manifest_rows.append([image_name, 'singular_matrix', None])
         except Exception as e:
             print(f"Skipping {image_path} due to unexpected error: {e}")
+            manifest_rows.append([image_name, 'error', None])
+
+    # Save the correction manifest (per shard if sharded, merged later by data_preprocessing.sharding)
+    manifest_file = shard_file_name(CORRECTION_PREFIX, '.csv', shard_index, num_shards)
+    manifest_df = pd.DataFrame(manifest_rows, columns=['image', 'status', 'corrected_path'])
+    manifest_df.to_csv(os.path.join(output_path, manifest_file), index=False)
+    if sharded:
+        write_shard_manifest(output_path, CORRECTION_PREFIX, shard_index, num_shards, manifest_file, image_list,
+                             input_id, shard_rows)
     
     print("\nColor correction complete!")
 
@@ -75,8 +100,22 @@ if __name__ == "__main__":
     Or
     python -m data_preprocessing.color_correction.full_pipeline <folder_path>
     to process all the images in the folder
+    Add --shard-index I --num-shards N to process only the I-th of N shards of the images
     '''
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('folder_path', type=str, help="Path to the folder containing the images.")
+    parser.add_argument('image_list', nargs='*', help="Images to process (default: all the images in the folder).")
+    parser.add_argument('--shard-index', type=int, default=None, help="Index of the shard to process (from 0).")
+    parser.add_argument('--num-shards', type=int, default=None, help="Total number of shards the images are split into.")
+
+    args = parser.parse_args()
+    try:
+        validate_shard_args(args.shard_index, args.num_shards)
+    except ValueError as e:
+        parser.error(str(e))
 
-    folder_path = sys.argv[1]
-    image_list = sys.argv[2:] if len(sys.argv) > 2 else None #process all the images if image_list is not specified
-    run_color_correction_pipeline(folder_path, image_list, printing=False)
+    image_list = args.image_list or None #process all the images if image_list is not specified
+    run_color_correction_pipeline(args.folder_path, image_list, printing=False,
+                                  shard_index=args.shard_index, num_shards=args.num_shards)
@@ -5,6 +5,8 @@ from PIL import Image
 from scipy.stats import skew, kurtosis
 import matplotlib.pyplot as plt
 
+from data_preprocessing.sharding import STATS_PREFIX, validate_shard_args, select_shard_df, input_fingerprint, shard_file_name, write_shard_manifest
+
 def apply_mask(img_folder_path, mask_folder_path, img_name, rotate=True, png = True, exist_printing=False):
     '''
     in our dataset there are existing masks for part of the images, and they are rotated
@@ -101,7 +103,7 @@ def calculate_rgb_stats_for_df(df, img_folder_path, mask_folder_path, rotate=Tru
         "Mean_G", "Std_G", "Skew_G", "Kurt_G",
         "Mean_B", "Std_B", "Skew_B", "Kurt_B"
     ]
-    stats_df = pd.DataFrame(stats_list, columns=stats_cols)
+    stats_df = pd.DataFrame(stats_list, columns=stats_cols, index=df.index)#keep df index so a shard of the table stays aligned
     df = pd.concat([df, stats_df], axis=1)
     df = df.dropna()#drop rows with missig stats = no masks or image
     return df
@@ -148,17 +150,37 @@ if __name__ == '__main__':
     parser.add_argument('--rotate', type=lambda x: x.lower() == 'true', default=True)
     parser.add_argument('--png', type=lambda x: x.lower() == 'true', default=True)
 
+    #optional for multi-node runs - process only one shard of the table rows
+    parser.add_argument('--shard-index', type=int, default=None, help="Index of the shard to process (from 0).")
+    parser.add_argument('--num-shards', type=int, default=None, help="Total number of shards the table rows are split into.")
+    parser.add_argument('--output_dir', type=str, default='.', help="Folder to save the stats table to (default: current folder).")
+
     #optional fro debaging - printing masked images
     parser.add_argument('--debug', type=lambda x: x.lower() == 'true', help="Enable debugging to visualize existing masked images.")
     parser.add_argument('--debug_limit', type=int, default=5, help="Number of existing masked images to visualize (default: 5).")
 
 
     args = parser.parse_args()
+    try:
+        sharded = validate_shard_args(args.shard_index, args.num_shards)
+    except ValueError as e:
+        parser.error(str(e))
 
     df = pd.read_excel(args.df)
+    if sharded:
+        input_id = input_fingerprint(df['Images'].tolist())
+        df = select_shard_df(df, args.shard_index, args.num_shards)
+        print(f"Shard {args.shard_index}/{args.num_shards}: {len(df)} rows")
+
     stats_df = calculate_rgb_stats_for_df(df, args.img_folder_path, args.mask_folder_path, args.rotate, args.png) 
-    stats_df.to_excel("stats_rgb_data.xlsx", index=False)
-    print("DataFrame with Stats of body-part colors saved to 'stats_rgb_data.xlsx'")
+    os.makedirs(args.output_dir, exist_ok=True)
+    stats_file = shard_file_name(STATS_PREFIX, '.xlsx', args.shard_index, args.num_shards)
+    stats_df.to_excel(os.path.join(args.output_dir, stats_file), index=False)
+    if sharded:
+        #original row positions let the merge restore the order of the full table
+        write_shard_manifest(args.output_dir, STATS_PREFIX, args.shard_index, args.num_shards, stats_file,
+                             df['Images'], input_id, stats_df.index)
+    print(f"DataFrame with Stats of body-part colors saved to '{os.path.join(args.output_dir, stats_file)}'")
     
     # Debugging: Visualize masked images if debug is enabled
     if args.debug:
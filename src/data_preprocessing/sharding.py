@@ -0,0 +1,252 @@
+import os
+import glob
+import json
+import hashlib
+import pandas as pd
+
+STATS_PREFIX = 'stats_rgb_data'
+CORRECTION_PREFIX = 'correction_manifest'
+
+
+def validate_shard_args(shard_index, num_shards):
+    '''
+    checks that shard_index/num_shards describe a valid shard: either both are None (unsharded run)
+    or both are given with num_shards >= 1 and 0 <= shard_index < num_shards, raises ValueError otherwise
+    returns True for a sharded run and False for an unsharded one
+    '''
+    if shard_index is None and num_shards is None:
+        return False
+    if shard_index is None or num_shards is None:
+        raise ValueError('shard_index and num_shards must be given together')
+    if num_shards < 1:
+        raise ValueError(f'num_shards must be at least 1, got {num_shards}')
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f'shard_index must be in [0, {num_shards - 1}], got {shard_index}')
+    return True
+
+
+def shard_of(image_name, num_shards):
+    '''
+    returns the shard index the image belongs to.
+    Uses md5 of the image name instead of python hash() since the latter is randomized
+    per process, and every node has to agree on the split without talking to each other.
+    md5 is only used as a stable hash here (usedforsecurity=False keeps it available on FIPS hosts);
+    do not change it, it would change the split of every existing run
+    '''
+    digest = hashlib.md5(str(image_name).encode('utf-8'), usedforsecurity=False).hexdigest()
+    return int(digest, 16) % num_shards
+
+
+def select_shard(image_list, shard_index, num_shards):
+    '''
+    returns the images of image_list that belong to the given shard, in the original order
+    '''
+    return [image_list[i] for i in select_shard_positions(image_list, shard_index, num_shards)]
+
+
+def select_shard_positions(image_list, shard_index, num_shards):
+    '''
+    returns the positions in image_list of the images that belong to the given shard
+    '''
+    validate_shard_args(shard_index, num_shards)
+    return [i for i, name in enumerate(image_list) if shard_of(name, num_shards) == shard_index]
+
+
+def select_shard_df(df, shard_index, num_shards, column='Images'):
+    '''
+    returns the rows of df whose image name (in column) belongs to the given shard.
+    The original index is kept, so the rows can be put back in the original order when merging
+    '''
+    validate_shard_args(shard_index, num_shards)
+    mask = df[column].map(lambda name: shard_of(name, num_shards) == shard_index)
+    return df[mask]
+
+
+def input_fingerprint(image_list):
+    '''
+    identifies the input of a sharded run: number of images and md5 of the full (unsharded) image list.
+    Stored in every shard manifest so shards left over from a run on another input are not merged
+    '''
+    digest = hashlib.md5(usedforsecurity=False)
+    for name in image_list:
+        digest.update(str(name).encode('utf-8') + b'\n')
+    return f'{len(image_list)}:{digest.hexdigest()}'
+
+
+def shard_suffix(shard_index, num_shards):
+    '''
+    suffix added to per-shard output names, e.g. shard-0003-of-0010
+    '''
+    return f'shard-{shard_index:04d}-of-{num_shards:04d}'
+
+
+def shard_file_name(prefix, extension, shard_index=None, num_shards=None):
+    '''
+    output file name for a shard: <prefix>.<shard_suffix><extension>,
+    or <prefix><extension> for an unsharded run (shard_index is None)
+    '''
+    if shard_index is None:
+        return f'{prefix}{extension}'
+    return f'{prefix}.{shard_suffix(shard_index, num_shards)}{extension}'
+
+
+def write_shard_manifest(output_dir, prefix, shard_index, num_shards, output_file, images, input_id, rows):
+    '''
+    writes the json manifest describing a finished shard next to its output,
+    merge_shards relies on it to check that all the shards are present exactly once
+
+    Args:
+    - output_dir (str): folder where the shard output was written.
+    - prefix (str): name of the output (STATS_PREFIX or CORRECTION_PREFIX).
+    - output_file (str): name of the shard output file inside output_dir.
+    - images (list): image names processed by the shard.
+    - input_id (str): input_fingerprint of the full input of the run, the same for all the shards.
+    - rows (list): original row positions of the shard output, used to restore the row order on merge.
+    '''
+    manifest = {
+        'prefix': prefix,
+        'shard_index': shard_index,
+        'num_shards': num_shards,
+        'input_id': input_id,
+        'output_file': output_file,
+        'images': [str(name) for name in images],
+        'rows': [int(row) for row in rows],
+    }
+
+    manifest_path = os.path.join(output_dir, shard_file_name(prefix, '.json', shard_index, num_shards))
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest_path
+
+
+def load_shard_manifests(output_dir, prefix, num_shards=None):
+    '''
+    reads all the shard manifests of prefix in output_dir and checks them:
+    all the shards have to come from the same input, every shard of the run has to be present exactly once,
+    and no image or row position can belong to two shards.
+    If num_shards is None, it is taken from the manifests (they all have to agree on it)
+    Returns the manifests sorted by shard index, raises ValueError if the shards are inconsistent
+    '''
+    paths = sorted(glob.glob(os.path.join(output_dir, f'{glob.escape(prefix)}.shard-*-of-*.json')))
+    if not paths:
+        raise ValueError(f'No shard manifests for {prefix} found in {output_dir}')
+
+    manifests = []
+    for path in paths:
+        with open(path) as f:
+            manifests.append(json.load(f))
+
+    input_ids = sorted({m['input_id'] for m in manifests})
+    if len(input_ids) > 1:
+        raise ValueError(f'Shard manifests for {prefix} come from runs on different inputs: {input_ids}')
+
+    found_num_shards = sorted({m['num_shards'] for m in manifests})
+    if num_shards is None:
+        if len(found_num_shards) > 1:
+            raise ValueError(f'Shard manifests from runs with different num_shards found: {found_num_shards}')
+        num_shards = found_num_shards[0]
+    elif found_num_shards != [num_shards]:
+        raise ValueError(f'Expected shards of a {num_shards}-shard run, found manifests for num_shards={found_num_shards}')
+
+    indices = [m['shard_index'] for m in manifests]
+    duplicate = sorted({i for i in indices if indices.count(i) > 1})
+    if duplicate:
+        raise ValueError(f'Duplicate shards for {prefix}: {duplicate}')
+    missing = sorted(set(range(num_shards)) - set(indices))
+    if missing:
+        raise ValueError(f'Missing shards for {prefix}: {missing} (of {num_shards})')
+
+    owner = {}
+    for m in manifests:
+        for name in set(m['images']):
+            if name in owner:
+                raise ValueError(f"Image {name} was processed by both shard {owner[name]} and shard {m['shard_index']}")
+            owner[name] = m['shard_index']
+
+    row_owner = {}
+    for m in manifests:
+        for row in m['rows']:
+            if row in row_owner:
+                raise ValueError(f"Row {row} is in both shard {row_owner[row]} and shard {m['shard_index']}")
+            row_owner[row] = m['shard_index']
+
+    return sorted(manifests, key=lambda m: m['shard_index'])
+
+
+def concat_shard_frames(frames):
+    '''
+    concatenates shard outputs indexed by original row position, in the original order.
+    Empty shards are left out since their columns come back from disk without dtypes
+    and would turn the merged columns to object
+    '''
+    non_empty = [frame for frame in frames if len(frame)] or frames[:1]
+    return pd.concat(non_empty).sort_index().reset_index(drop=True)
+
+
+def merge_stats_shards(output_dir, num_shards=None, output_path=None):
+    '''
+    combines the per-shard stats tables written by the segmentation pipeline into
+    stats_rgb_data.xlsx, restoring the row order of the original table
+    '''
+    manifests = load_shard_manifests(output_dir, STATS_PREFIX, num_shards)
+    frames = []
+    for m in manifests:
+        shard_df = pd.read_excel(os.path.join(output_dir, m['output_file']))
+        if len(shard_df) != len(m['rows']):
+            raise ValueError(f"Shard {m['shard_index']}: {len(shard_df)} rows in {m['output_file']}, manifest lists {len(m['rows'])}")
+        shard_df.index = m['rows']
+        frames.append(shard_df)
+    merged_df = concat_shard_frames(frames)
+
+    if output_path is None:
+        output_path = os.path.join(output_dir, shard_file_name(STATS_PREFIX, '.xlsx'))
+    merged_df.to_excel(output_path, index=False)
+    return merged_df
+
+
+def merge_correction_shards(output_dir, num_shards=None, output_path=None):
+    '''
+    combines the per-shard correction manifests written by the color correction pipeline
+    into correction_manifest.csv, restoring the order of the original image list
+    '''
+    manifests = load_shard_manifests(output_dir, CORRECTION_PREFIX, num_shards)
+    frames = []
+    for m in manifests:
+        shard_df = pd.read_csv(os.path.join(output_dir, m['output_file']), dtype={'image': str})
+        if shard_df['image'].tolist() != m['images']:
+            raise ValueError(f"Shard {m['shard_index']}: images in {m['output_file']} do not match its manifest")
+        shard_df.index = m['rows']
+        frames.append(shard_df)
+    merged_df = concat_shard_frames(frames)
+
+    if output_path is None:
+        output_path = os.path.join(output_dir, shard_file_name(CORRECTION_PREFIX, '.csv'))
+    merged_df.to_csv(output_path, index=False)
+    return merged_df
+
+
+if __name__ == '__main__':
+    '''Usage:
+    python -m data_preprocessing.sharding stats <output_dir> [--num-shards N]
+    to merge the stats tables of the segmentation shards into stats_rgb_data.xlsx
+    Or
+    python -m data_preprocessing.sharding correction <output_dir> [--num-shards N]
+    to merge the correction manifests of the color correction shards into correction_manifest.csv
+    '''
+    import argparse
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('kind', choices=['stats', 'correction'], help="Which shard outputs to merge.")
+    parser.add_argument('output_dir', type=str, help="Folder containing the shard outputs and their manifests.")
+    parser.add_argument('--num-shards', type=int, default=None, help="Expected number of shards (default: taken from the manifests).")
+
+    args = parser.parse_args()
+
+    try:
+        if args.kind == 'stats':
+            merged_df = merge_stats_shards(args.output_dir, args.num_shards)
+        else:
+            merged_df = merge_correction_shards(args.output_dir, args.num_shards)
+    except ValueError as e:
+        parser.exit(1, f'Merge failed: {e}\n')
+    print(f'Merged {len(merged_df)} rows of {args.kind} shards in {args.output_dir}')
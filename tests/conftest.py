@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the package lives in src/ and is run from there (python -m data_preprocessing...)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
@@ -0,0 +1,186 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from data_preprocessing.sharding import (
+    STATS_PREFIX, CORRECTION_PREFIX, validate_shard_args, select_shard, select_shard_df,
+    input_fingerprint, shard_file_name, write_shard_manifest, load_shard_manifests,
+    merge_stats_shards, merge_correction_shards,
+)
+
+NUM_SHARDS = 3
+
+
+@pytest.fixture
+def df():
+    return pd.DataFrame({
+        'Images': [f'img_{i:03d}.jpg' for i in range(30)],
+        'Hemoglobin': np.linspace(8, 14, 30),
+    })
+
+
+def write_stats_shard(output_dir, df, shard_index, num_shards=NUM_SHARDS, drop_every=None, input_id=None):
+    '''same outputs as the segmentation __main__ for one shard, optionally dropping rows like dropna does'''
+    shard_df = select_shard_df(df, shard_index, num_shards)
+    stats_df = shard_df
+    if drop_every is not None:
+        stats_df = shard_df[shard_df.index % drop_every != 0]
+    stats_file = shard_file_name(STATS_PREFIX, '.xlsx', shard_index, num_shards)
+    stats_df.to_excel(os.path.join(output_dir, stats_file), index=False)
+    if input_id is None:
+        input_id = input_fingerprint(df['Images'].tolist())
+    return write_shard_manifest(output_dir, STATS_PREFIX, shard_index, num_shards, stats_file,
+                                shard_df['Images'], input_id, stats_df.index)
+
+
+def write_stats_run(output_dir, df, num_shards=NUM_SHARDS, drop_every=None):
+    for shard_index in range(num_shards):
+        write_stats_shard(output_dir, df, shard_index, num_shards, drop_every)
+
+
+def test_validate_shard_args():
+    assert validate_shard_args(None, None) is False
+    assert validate_shard_args(2, 3) is True
+    for shard_index, num_shards in [(0, None), (None, 4), (3, 3), (-1, 3), (0, 0)]:
+        with pytest.raises(ValueError):
+            validate_shard_args(shard_index, num_shards)
+
+
+def test_select_shard_is_complete_disjoint_and_stable(df):
+    image_list = df['Images'].tolist()
+    shards = [select_shard(image_list, k, NUM_SHARDS) for k in range(NUM_SHARDS)]
+
+    assert sorted(sum(shards, [])) == sorted(image_list)
+    assert sum(len(shard) for shard in shards) == len(image_list)
+    assert shards == [select_shard(image_list, k, NUM_SHARDS) for k in range(NUM_SHARDS)]
+    # the split depends only on the name, not on the list it comes from
+    assert select_shard(image_list[::-1], 1, NUM_SHARDS) == shards[1][::-1]
+
+
+def test_select_shard_df_is_complete_disjoint_and_stable(df):
+    shards = [select_shard_df(df, k, NUM_SHARDS) for k in range(NUM_SHARDS)]
+
+    indices = np.concatenate([shard.index for shard in shards])
+    assert sorted(indices) == list(df.index)
+    for k, shard in enumerate(shards):
+        assert shard.index.tolist() == select_shard_df(df, k, NUM_SHARDS).index.tolist()
+        assert shard['Images'].tolist() == select_shard(df['Images'].tolist(), k, NUM_SHARDS)
+
+
+def test_merge_stats_restores_order_after_dropna(df, tmp_path):
+    write_stats_run(tmp_path, df, drop_every=4)
+
+    merged_df = merge_stats_shards(tmp_path)
+
+    expected_df = df[df.index % 4 != 0].reset_index(drop=True)
+    pd.testing.assert_frame_equal(merged_df, expected_df)
+    assert os.path.exists(tmp_path / 'stats_rgb_data.xlsx')
+
+
+def test_merge_stats_with_empty_shard(tmp_path):
+    # all the images hash to a single shard, the other shards are empty
+    df = pd.DataFrame({'Images': ['only.jpg', 'only.jpg'], 'Hemoglobin': [9.5, 12.3]})
+    write_stats_run(tmp_path, df)
+
+    manifests = load_shard_manifests(tmp_path, STATS_PREFIX)
+    assert sorted(len(m['rows']) for m in manifests) == [0, 0, 2]
+    pd.testing.assert_frame_equal(merge_stats_shards(tmp_path), df)
+
+
+def test_missing_shard(df, tmp_path):
+    write_stats_run(tmp_path, df)
+    os.remove(tmp_path / shard_file_name(STATS_PREFIX, '.json', 1, NUM_SHARDS))
+
+    with pytest.raises(ValueError, match='Missing shards'):
+        load_shard_manifests(tmp_path, STATS_PREFIX)
+
+
+def test_duplicate_manifest(df, tmp_path):
+    write_stats_run(tmp_path, df)
+    manifest_path = tmp_path / shard_file_name(STATS_PREFIX, '.json', 1, NUM_SHARDS)
+    shutil.copy(manifest_path, str(manifest_path).replace('.json', ' (copy).json'))
+
+    with pytest.raises(ValueError, match='Duplicate shards'):
+        load_shard_manifests(tmp_path, STATS_PREFIX)
+
+
+def test_mixed_num_shards(df, tmp_path):
+    write_stats_run(tmp_path, df)
+    write_stats_shard(tmp_path, df, 0, num_shards=4)
+
+    with pytest.raises(ValueError, match='different num_shards'):
+        load_shard_manifests(tmp_path, STATS_PREFIX)
+    with pytest.raises(ValueError, match='Expected shards of a 3-shard run'):
+        load_shard_manifests(tmp_path, STATS_PREFIX, num_shards=NUM_SHARDS)
+
+
+def test_image_in_two_shards(df, tmp_path):
+    write_stats_run(tmp_path, df)
+    # shard 0 claims an image of shard 1, e.g. run over a different image list
+    stolen = select_shard(df['Images'].tolist(), 1, NUM_SHARDS)[0]
+    shard_df = select_shard_df(df, 0, NUM_SHARDS)
+    write_shard_manifest(tmp_path, STATS_PREFIX, 0, NUM_SHARDS, shard_file_name(STATS_PREFIX, '.xlsx', 0, NUM_SHARDS),
+                         shard_df['Images'].tolist() + [stolen], input_fingerprint(df['Images'].tolist()), shard_df.index)
+
+    with pytest.raises(ValueError, match=f'Image {stolen}'):
+        load_shard_manifests(tmp_path, STATS_PREFIX)
+
+
+def test_stale_shard_from_other_input(df, tmp_path):
+    old_df = pd.DataFrame({'Images': [f'old_{i:03d}.jpg' for i in range(10)], 'Hemoglobin': np.ones(10)})
+    write_stats_run(tmp_path, old_df)
+    # new run on another table, shard 2 failed so the old shard 2 is still there
+    for shard_index in range(2):
+        write_stats_shard(tmp_path, df, shard_index)
+
+    with pytest.raises(ValueError, match='different inputs'):
+        merge_stats_shards(tmp_path)
+
+
+def test_overlapping_rows(df, tmp_path):
+    write_stats_run(tmp_path, df)
+    shard_df = select_shard_df(df, 0, NUM_SHARDS)
+    other_rows = select_shard_df(df, 1, NUM_SHARDS).index[:len(shard_df)]
+    write_shard_manifest(tmp_path, STATS_PREFIX, 0, NUM_SHARDS, shard_file_name(STATS_PREFIX, '.xlsx', 0, NUM_SHARDS),
+                         shard_df['Images'], input_fingerprint(df['Images'].tolist()), other_rows)
+
+    with pytest.raises(ValueError, match='Row'):
+        merge_stats_shards(tmp_path)
+
+
+def write_correction_run(output_dir, image_list, num_shards=NUM_SHARDS):
+    '''same outputs as run_color_correction_pipeline for every shard, without the images themselves'''
+    input_id = input_fingerprint(image_list)
+    for shard_index in range(num_shards):
+        shard_images = select_shard(image_list, shard_index, num_shards)
+        shard_rows = [image_list.index(name) for name in shard_images]
+        manifest_file = shard_file_name(CORRECTION_PREFIX, '.csv', shard_index, num_shards)
+        pd.DataFrame({
+            'image': shard_images,
+            'status': ['corrected'] * len(shard_images),
+            'corrected_path': [os.path.join(output_dir, name) for name in shard_images],
+        }).to_csv(os.path.join(output_dir, manifest_file), index=False)
+        write_shard_manifest(output_dir, CORRECTION_PREFIX, shard_index, num_shards, manifest_file,
+                             shard_images, input_id, shard_rows)
+
+
+def test_merge_correction_keeps_list_order(df, tmp_path):
+    image_list = df['Images'].tolist()[::-1]
+    write_correction_run(tmp_path, image_list)
+
+    merged_df = merge_correction_shards(tmp_path)
+
+    assert merged_df['image'].tolist() == image_list
+    assert os.path.exists(tmp_path / 'correction_manifest.csv')
+
+
+def test_merge_correction_detects_truncated_shard(df, tmp_path):
+    write_correction_run(tmp_path, df['Images'].tolist())
+    shard_csv = tmp_path / shard_file_name(CORRECTION_PREFIX, '.csv', 2, NUM_SHARDS)
+    pd.read_csv(shard_csv).iloc[:-1].to_csv(shard_csv, index=False)
+
+    with pytest.raises(ValueError, match='do not match its manifest'):
+        merge_correction_shards(tmp_path)